@@ -1,7 +1,10 @@
+import asyncio
 import pandas as pd
-import requests
-import time
+import httpx
+import shelve
 import sys
+import time
+from aiolimiter import AsyncLimiter
 from tqdm import tqdm
 
 # --- Configuration ---
@@ -23,19 +26,43 @@ OUTPUT_SIMILARITY_COLUMN = "similarity" # To include the similarity column from
 # UniProt API base URL for sequence search
 UNIPROT_API_SEARCH_URL = "https://rest.uniprot.org/uniprotkb/search"
 
-# Rate limit for UniProt API requests (in seconds)
-# This delay prevents hitting UniProt's rate limits and ensures polite API usage.
-# UniProt recommends max 1 request/second for batch, or 0.1-0.5 for individual.
-API_REQUEST_DELAY = 0.2  # 200 milliseconds
+# Rate limit for UniProt API requests, enforced by a token bucket: short bursts
+# up to MAX_REQUESTS_PER_PERIOD are allowed while the AVERAGE rate over the
+# period stays bounded. This keeps API usage polite without inserting a fixed
+# sleep after every single request.
+MAX_REQUESTS_PER_PERIOD = 5
+RATE_LIMIT_PERIOD = 1.0  # seconds
+
+# Timeout (in seconds) for each UniProt API request
+API_REQUEST_TIMEOUT = 30.0
+
+# Number of hTF names bundled into a single OR-joined UniProt query.
+# Batching K names per request turns K HTTP round-trips (each paced by the
+# rate-limit delay) into ceil(K / BATCH_SIZE) round-trips.
+BATCH_SIZE = 100
+
+# Maximum number of entries requested per batch response page. UniProt caps
+# `size` at 500; one page is enough for BATCH_SIZE names plus ambiguous hits.
+BATCH_RESULT_SIZE = 500
+
+# Persistent on-disk cache of fetched sequences, keyed by hTF name. Re-runs,
+# crashes, and inputs with newly added pairs only hit the UniProt API for names
+# that were never resolved before (or whose cache entry has expired).
+CACHE_FILE = "data/.uniprot_cache.db"
+
+# Cache entries older than this many days are refreshed from UniProt, so
+# sequence updates in UniProtKB eventually propagate into re-runs.
+CACHE_MAX_AGE_DAYS = 30
 
 # --- Function to fetch sequence from UniProt by protein name ---
-def fetch_sequence_from_protein_name(protein_name: str) -> str | None:
+async def fetch_sequence_from_protein_name(client: httpx.AsyncClient, protein_name: str) -> str | None:
     """
     Fetches the protein sequence for a given human transcription factor (hTF) name from UniProtKB.
     It queries UniProt for reviewed human entries matching the protein name and extracts
     the primary protein sequence.
 
     Args:
+        client (httpx.AsyncClient): Shared HTTP client (connection pooling / HTTP2 multiplexing).
         protein_name (str): The name of the human transcription factor (e.g., HOXB8).
 
     Returns:
@@ -49,7 +76,7 @@ def fetch_sequence_from_protein_name(protein_name: str) -> str | None:
     }
 
     try:
-        response = requests.get(UNIPROT_API_SEARCH_URL, params=query_params)
+        response = await client.get(UNIPROT_API_SEARCH_URL, params=query_params)
         response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
         data = response.json()
 
@@ -62,7 +89,7 @@ def fetch_sequence_from_protein_name(protein_name: str) -> str | None:
             # print(f"  No reviewed human sequence found for '{protein_name}'.", file=sys.stderr)
             return None
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"\nError fetching sequence for protein '{protein_name}': {e}", file=sys.stderr)
         return None
     except KeyError as e:
@@ -72,6 +99,105 @@ def fetch_sequence_from_protein_name(protein_name: str) -> str | None:
         print(f"\nNo sequence value found in UniProt response for protein '{protein_name}'.", file=sys.stderr)
         return None
 
+# --- Function to fetch sequences for a whole batch of protein names at once ---
+async def fetch_sequences_batch(client: httpx.AsyncClient, protein_names: list) -> dict:
+    """
+    Fetches sequences for a batch of hTF names in a single UniProt request by
+    OR-joining the names into one query. Each returned entry is matched back to
+    the requested names through its gene names (primary name and synonyms).
+
+    Args:
+        client (httpx.AsyncClient): Shared HTTP client.
+        protein_names (list): Batch of hTF names to resolve.
+
+    Returns:
+        dict: Mapping of hTF name -> sequence for every name that resolved in
+              this batch. Names missing from the result need an individual query.
+    """
+    # Construct one OR-joined query for the whole batch, restricted to reviewed human entries
+    query_params = {
+        "query": f"({' OR '.join(protein_names)}) AND (taxonomy_id:9606) AND (reviewed:true)",
+        "fields": "accession,gene_names,sequence",  # gene_names is needed to match results back
+        "size": BATCH_RESULT_SIZE,
+        "format": "json"
+    }
+
+    resolved = {}
+    try:
+        response = await client.get(UNIPROT_API_SEARCH_URL, params=query_params)
+        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
+        data = response.json()
+    except httpx.HTTPError as e:
+        print(f"\nError fetching batch of {len(protein_names)} proteins: {e}", file=sys.stderr)
+        return resolved
+
+    # Match every returned entry back to the requested names via its gene names.
+    # UniProt orders results by relevance, so the first entry claiming a name wins.
+    wanted = {name.upper(): name for name in protein_names}
+    for entry in data.get('results', []):
+        sequence = entry.get('sequence', {}).get('value')
+        if not sequence:
+            continue
+        for gene in entry.get('genes', []):
+            candidates = [gene.get('geneName', {}).get('value')]
+            candidates.extend(synonym.get('value') for synonym in gene.get('synonyms', []))
+            for candidate in candidates:
+                if candidate and candidate.upper() in wanted:
+                    resolved.setdefault(wanted[candidate.upper()], sequence)
+
+    return resolved
+
+# --- Function to fetch all unique sequences concurrently ---
+async def fetch_all_sequences(htf_names: list) -> dict:
+    """
+    Fetches sequences for all given hTF names over a single pooled HTTP/2
+    connection. Names are resolved in OR-joined batches of BATCH_SIZE first;
+    any name the batch response could not be matched to falls back to an
+    individual query. A shared token bucket caps the request rate at
+    MAX_REQUESTS_PER_PERIOD per RATE_LIMIT_PERIOD across all in-flight
+    coroutines, allowing short bursts while the average stays within
+    UniProt's allowance.
+
+    Args:
+        htf_names (list): Unique hTF names to query.
+
+    Returns:
+        dict: Mapping of hTF name -> sequence (or None if no sequence was found).
+    """
+    limiter = AsyncLimiter(MAX_REQUESTS_PER_PERIOD, RATE_LIMIT_PERIOD)
+    sequence_map = {}
+
+    async def fetch_batch(batch: list) -> dict:
+        async with limiter:
+            resolved = await fetch_sequences_batch(client, batch)
+        batch_progress.update(1)
+        return resolved
+
+    async def fetch_one(name: str) -> tuple:
+        async with limiter:
+            sequence = await fetch_sequence_from_protein_name(client, name)
+        fallback_progress.update(1)
+        return name, sequence
+
+    async with httpx.AsyncClient(http2=True, timeout=API_REQUEST_TIMEOUT) as client:
+        # Phase 1: resolve as many names as possible via bulk OR-joined queries
+        batches = [htf_names[i:i + BATCH_SIZE] for i in range(0, len(htf_names), BATCH_SIZE)]
+        batch_progress = tqdm(total=len(batches), desc="Fetching sequence batches from UniProt")
+        for resolved in await asyncio.gather(*(fetch_batch(batch) for batch in batches)):
+            sequence_map.update(resolved)
+        batch_progress.close()
+
+        # Phase 2: individually query the names the batch responses did not cover
+        # (ambiguous gene names, entries beyond the result page, etc.)
+        unresolved = [name for name in htf_names if name not in sequence_map]
+        if unresolved:
+            print(f"{len(unresolved)} names unresolved by batch queries, fetching individually...")
+            fallback_progress = tqdm(total=len(unresolved), desc="Fetching remaining sequences")
+            sequence_map.update(await asyncio.gather(*(fetch_one(name) for name in unresolved)))
+            fallback_progress.close()
+
+    return sequence_map
+
 # --- Main Script Execution ---
 def main():
     """
@@ -98,14 +224,35 @@ def main():
     all_htf_names.update(df_input[INPUT_HTF2_COLUMN].unique())
     print(f"Found {len(all_htf_names)} unique hTF names to query for sequences.")
 
-    # 2. Fetch sequences for all unique names and store them in a dictionary (acting as a cache)
+    # 2. Resolve names from the persistent on-disk cache first, then fetch only
+    # the truly new (or expired) names from UniProt. The async client pools
+    # connections and keeps a bounded number of requests in flight, so
+    # wall-clock time is no longer one full round-trip plus delay per name.
     sequence_map = {}
-    # tqdm provides a progress bar for the API calls, enhancing user experience.
-    for htf_name in tqdm(list(all_htf_names), desc="Fetching sequences from UniProt"):
-        if htf_name not in sequence_map:
-            sequence = fetch_sequence_from_protein_name(htf_name)
-            sequence_map[htf_name] = sequence
-            time.sleep(API_REQUEST_DELAY)  # Pause to respect UniProt API rate limits
+    names_to_fetch = []
+    now = time.time()
+    max_cache_age = CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+    with shelve.open(CACHE_FILE) as cache:
+        for htf_name in sorted(all_htf_names):
+            cached_entry = cache.get(htf_name)
+            if cached_entry is not None:
+                sequence, fetched_at = cached_entry
+                if now - fetched_at <= max_cache_age:
+                    sequence_map[htf_name] = sequence
+                    continue
+            names_to_fetch.append(htf_name)
+
+        print(f"{len(sequence_map)} sequences served from cache, "
+              f"{len(names_to_fetch)} to fetch from UniProt.")
+
+        if names_to_fetch:
+            fetched_map = asyncio.run(fetch_all_sequences(names_to_fetch))
+            sequence_map.update(fetched_map)
+            # Persist only successful fetches (with a timestamp for expiry), so
+            # transient failures and unresolved names are retried on the next run
+            for htf_name, sequence in fetched_map.items():
+                if sequence is not None:
+                    cache[htf_name] = (sequence, now)
 
     print("\nFinished fetching all unique sequences.")
 
@@ -1,10 +1,41 @@
 import pandas as pd
+import numpy as np
 import parasail
 import multiprocessing
+from multiprocessing import shared_memory
 import argparse
+import csv
+import mmap
 from tqdm import tqdm
 import sys
-import math
+
+# Numba is optional: with it the banded Needleman-Wunsch fast path runs as
+# compiled machine code; without it close homologs simply take the regular
+# parasail SIMD kernel instead.
+try:
+    import numba
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+# CuPy is optional as well: with it (and a CUDA device) the rare very-long
+# pairs are aligned on the GPU, sweeping the DP matrix one anti-diagonal at a
+# time; without it every pair stays on the CPU kernels.
+try:
+    import cupy
+    _CUPY_AVAILABLE = True
+except ImportError:
+    _CUPY_AVAILABLE = False
+
+# pyarrow is optional and only needed when the output path ends in ".parquet":
+# parquet files with int16 result columns are ~10x smaller than the CSV and
+# much faster for downstream tools to re-load.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    _PYARROW_AVAILABLE = True
+except ImportError:
+    _PYARROW_AVAILABLE = False
 
 # Constants for Alignment
 # SCORING_MATRIX: BLOSUM62 is a widely used substitution matrix for protein alignment
@@ -14,61 +45,625 @@ GAP_OPEN_PENALTY = 10
 # GAP_EXTEND_PENALTY: Penalty for extending an existing gap
 GAP_EXTEND_PENALTY = 1
 
-# Function to calculate similarity for a single pair
-def calculate_similarity_for_pair(row: dict) -> tuple:
+# Constants for the k-mer prefilter (DADA2-style screen)
+# KMER_SIZE: Length of the amino-acid k-mers used for the fast pre-alignment screen
+KMER_SIZE = 5
+# KMER_SCREEN_THRESHOLD: Minimum fraction of shared k-mers (relative to the shorter
+# sequence) required before a full Needleman-Wunsch alignment is attempted. Pairs
+# below this threshold are clearly non-homologous and are reported as 0% identity.
+KMER_SCREEN_THRESHOLD = 0.1
+# KMER_BANDED_THRESHOLD: Shared k-mer fraction above which a pair is a close homolog
+# whose optimal global alignment stays near the main diagonal, so the banded
+# Needleman-Wunsch fast path can be used instead of the full-matrix SIMD kernel.
+KMER_BANDED_THRESHOLD = 0.5
+# BAND_WIDTH: Half-width of the banded DP corridor around the diagonal. The
+# effective band is widened by the length difference of the pair so that the
+# (m, n) endpoint always lies inside the band.
+BAND_WIDTH = 32
+
+# GPU_CELL_THRESHOLD: Minimum DP matrix size (len1 * len2) before a pair is
+# routed to the GPU kernel. Below this, kernel-launch and transfer overhead
+# outweighs the parallelism, so short pairs stay on the CPU.
+GPU_CELL_THRESHOLD = 2_000_000
+
+# STATS_RESCORE_THRESHOLD: Score-normalized identity estimate (in percent) above
+# which a pair is treated as a real homolog and re-aligned with the stats kernel
+# for exact match counts. parasail's nw_stats runs a second accumulation pass on
+# top of the scoring pass, so pairs whose estimate stays below this threshold
+# keep the cheap score-only result -- their exact identity is not informative.
+STATS_RESCORE_THRESHOLD = 30.0
+
+# Amino-acid alphabet in the row/column order of parasail's BLOSUM62 matrix
+# (unknown or ambiguous residues are mapped to 'X').
+_AA_ALPHABET = "ARNDCQEGHILKMFPSTWYVBZX*"
+# Both lookup tables live in anonymous mmap buffers created at import time,
+# i.e. before the worker pool forks. With the Linux `fork` start method all
+# workers then read the SAME physical pages (nothing writes them after this
+# block), so the tables stay hot in one shared cache set instead of being
+# duplicated into every worker process. The numpy views below are plain
+# arrays over those buffers.
+
+# Byte-value -> matrix-index lookup table: encoding a whole sequence is a single
+# vectorized fancy-indexing operation instead of a per-character dict lookup.
+_AA_TO_IDX_MMAP = mmap.mmap(-1, 256, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+AA_TO_IDX = np.frombuffer(_AA_TO_IDX_MMAP, dtype=np.int8)
+AA_TO_IDX[:] = _AA_ALPHABET.index('X')
+AA_TO_IDX[np.frombuffer(_AA_ALPHABET.encode('ascii'), dtype=np.uint8)] = \
+    np.arange(len(_AA_ALPHABET), dtype=np.int8)
+
+# BLOSUM62 as one contiguous (24, 24) int8 array: the whole table fits in a few
+# cache lines, so each substitution lookup in the banded kernel is a single L1 load
+_blosum62_host = np.asarray(SCORING_MATRIX.matrix, dtype=np.int8)
+_BLOSUM62_MMAP = mmap.mmap(-1, _blosum62_host.size, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+_BLOSUM62_I8 = np.frombuffer(_BLOSUM62_MMAP, dtype=np.int8).reshape(_blosum62_host.shape)
+_BLOSUM62_I8[:] = _blosum62_host
+del _blosum62_host
+
+# Score used for cells outside the band / unreachable alignment states.
+# Large enough (in magnitude) to never win a max(), small enough not to overflow int32.
+_NEG_INF = -(10 ** 7)
+
+# Per-process cache of integer-encoded sequences, keyed by hTF name, so each
+# unique sequence is translated to matrix indices only once per worker.
+_ENCODE_CACHE = {}
+
+# Per-process cache of BLOSUM62 self-alignment scores, keyed by hTF name.
+_SELF_SCORE_CACHE = {}
+
+# Helper to translate a protein sequence into BLOSUM62 row indices
+def _encode_sequence(name: str, seq: str) -> np.ndarray:
+    """
+    Encodes a protein sequence as an int8 array of BLOSUM62 row indices via the
+    vectorized AA_TO_IDX lookup table (residues outside the standard alphabet
+    map to 'X'), caching the result per hTF name.
+    """
+    encoded = _ENCODE_CACHE.get(name)
+    if encoded is None:
+        encoded = AA_TO_IDX[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+        _ENCODE_CACHE[name] = encoded
+    return encoded
+
+# Helper to get the BLOSUM62 score of a sequence aligned to itself
+def _self_score(name: str, seq: str) -> int:
+    """
+    Returns the BLOSUM62 score of aligning `seq` to itself (the sum of the
+    diagonal substitution scores), cached per hTF name. Used to normalize raw
+    alignment scores into a percent-identity estimate.
+    """
+    score = _SELF_SCORE_CACHE.get(name)
+    if score is None:
+        encoded = _encode_sequence(name, seq).astype(np.intp)
+        score = int(_BLOSUM62_I8[encoded, encoded].sum(dtype=np.int64))
+        _SELF_SCORE_CACHE[name] = score
+    return score
+
+# Banded Needleman-Wunsch DP kernel (compiled by Numba when available)
+def _nw_banded_kernel(s1: np.ndarray, s2: np.ndarray, blosum: np.ndarray,
+                      gap_open: int, gap_ext: int, radius: int) -> tuple:
+    """
+    Core banded Gotoh DP plus traceback, written with plain loops over numpy
+    arrays so Numba can compile it to machine code. The DP states are stored in
+    band-offset layout: column k = j - i + radius of row i holds cell (i, j),
+    so allocation, initialization, and fill are all O(band * max(m, n)) -- no
+    full (m+1) x (n+1) matrix ever exists. Takes integer-encoded sequences and
+    the substitution matrix as arrays; returns (matches, length).
+    """
+    m, n = len(s1), len(s2)
+    width = 2 * radius + 1
+
+    # Three-state Gotoh DP in band-offset layout:
+    # H = best score, E = gap in seq1 (left), F = gap in seq2 (up)
+    H = np.full((m + 1, width), _NEG_INF, dtype=np.int32)
+    E = np.full((m + 1, width), _NEG_INF, dtype=np.int32)
+    F = np.full((m + 1, width), _NEG_INF, dtype=np.int32)
+    # Traceback pointers: for H 0=diagonal, 1=close E (left) chain, 2=close F (up) chain;
+    # for E/F 0=opened from H, 1=extended the existing gap
+    ptr_H = np.zeros((m + 1, width), dtype=np.uint8)
+    ptr_E = np.zeros((m + 1, width), dtype=np.uint8)
+    ptr_F = np.zeros((m + 1, width), dtype=np.uint8)
+
+    # Boundary conditions: leading gaps along the first row/column.
+    # Cell (i, j) lives at column k = j - i + radius of row i.
+    H[0, radius] = 0
+    for j in range(1, min(n, radius) + 1):
+        k = radius + j
+        E[0, k] = -(gap_open + (j - 1) * gap_ext)
+        H[0, k] = E[0, k]
+        ptr_H[0, k] = 1
+        ptr_E[0, k] = 0 if j == 1 else 1
+    for i in range(1, min(m, radius) + 1):
+        k = radius - i
+        F[i, k] = -(gap_open + (i - 1) * gap_ext)
+        H[i, k] = F[i, k]
+        ptr_H[i, k] = 2
+        ptr_F[i, k] = 0 if i == 1 else 1
+
+    # Fill the band row by row; cells outside it keep their _NEG_INF default.
+    # In this layout the neighbours of (i, k) are: (i, j-1) -> (i, k-1),
+    # (i-1, j) -> (i-1, k+1), and (i-1, j-1) -> (i-1, k).
+    for i in range(1, m + 1):
+        lo = max(1, i - radius)
+        hi = min(n, i + radius)
+        for j in range(lo, hi + 1):
+            k = j - i + radius
+
+            # Gap in seq1 (consume seq2[j-1]): open a new gap or extend the
+            # current one; the left neighbour falls off the band edge at k == 0
+            if k > 0:
+                e_open = H[i, k - 1] - gap_open
+                e_ext = E[i, k - 1] - gap_ext
+            else:
+                e_open = _NEG_INF
+                e_ext = _NEG_INF
+            if e_open >= e_ext:
+                E[i, k] = e_open
+                ptr_E[i, k] = 0
+            else:
+                E[i, k] = e_ext
+                ptr_E[i, k] = 1
+
+            # Gap in seq2 (consume seq1[i-1]): open a new gap or extend the
+            # current one; the up neighbour falls off the band edge at k == width - 1
+            if k < width - 1:
+                f_open = H[i - 1, k + 1] - gap_open
+                f_ext = F[i - 1, k + 1] - gap_ext
+            else:
+                f_open = _NEG_INF
+                f_ext = _NEG_INF
+            if f_open >= f_ext:
+                F[i, k] = f_open
+                ptr_F[i, k] = 0
+            else:
+                F[i, k] = f_ext
+                ptr_F[i, k] = 1
+
+            # Best of: diagonal substitution, or closing one of the gap states
+            diag = H[i - 1, k] + blosum[s1[i - 1], s2[j - 1]]
+            best, p = diag, 0
+            if E[i, k] > best:
+                best, p = E[i, k], 1
+            if F[i, k] > best:
+                best, p = F[i, k], 2
+            H[i, k] = best
+            ptr_H[i, k] = p
+
+    # Traceback from (m, n) counting matches and total alignment columns;
+    # pointer lookups translate (i, j) to the band column on the fly
+    matches = 0
+    length = 0
+    i, j = m, n
+    state = 0  # 0 = H, 1 = E, 2 = F
+    while i > 0 or j > 0:
+        k = j - i + radius
+        if state == 0:
+            p = ptr_H[i, k]
+            if p == 0:
+                length += 1
+                if s1[i - 1] == s2[j - 1]:
+                    matches += 1
+                i -= 1
+                j -= 1
+            else:
+                state = p  # hand over to the gap state at the same cell
+        elif state == 1:
+            p = ptr_E[i, k]
+            length += 1
+            j -= 1
+            state = 1 if p == 1 else 0
+        else:
+            p = ptr_F[i, k]
+            length += 1
+            i -= 1
+            state = 2 if p == 1 else 0
+
+    return matches, length
+
+# Compile the DP kernel to machine code when Numba is present. `cache=True`
+# persists the compiled kernel on disk, so only the very first run pays the
+# compilation cost; forked pool workers inherit the compiled function.
+if _NUMBA_AVAILABLE:
+    _nw_banded_kernel = numba.njit(cache=True)(_nw_banded_kernel)
+
+# Banded Needleman-Wunsch with affine gaps for close homologs
+def _nw_banded_stats(s1: np.ndarray, s2: np.ndarray) -> tuple:
     """
-    Calculates the global alignment (Needleman-Wunsch) percent identity
-    for a pair of protein sequences using the parasail library.
+    Computes a global (Needleman-Wunsch) alignment of two integer-encoded
+    sequences (see `_encode_sequence`) restricted to a band around the main
+    diagonal, with affine gap costs matching the parasail call
+    (GAP_OPEN_PENALTY for the first gap residue, GAP_EXTEND_PENALTY after).
+
+    TF paralogs align close to the diagonal, so confining the DP to a band of
+    half-width BAND_WIDTH (+ the length difference) reduces the work from
+    O(m*n) to O(band * max(m, n)). Only valid for pairs the k-mer screen has
+    already flagged as close homologs -- for distant pairs the optimal path may
+    leave the band and the caller must use the unbanded SIMD kernel instead.
 
     Args:
-        row (dict): A dictionary representing a row from the input DataFrame,
-                    expected to contain 'hTF1', 'Sequence_hTF1', 'hTF2', 'Sequence_hTF2'.
+        s1 (np.ndarray): First sequence as int8 BLOSUM62 row indices.
+        s2 (np.ndarray): Second sequence as int8 BLOSUM62 row indices.
 
     Returns:
-        tuple: A tuple (hTF1, hTF2, similarity_score).
-               similarity_score will be a float (percent identity) or math.nan
-               if sequences were not found or are invalid.
+        tuple: (matches, length) of the banded optimal alignment, where `length`
+               is the number of alignment columns (matches + mismatches + gaps).
     """
-    hTF1 = row['hTF1']
-    hTF2 = row['hTF2']
-    seq1 = row['Sequence_hTF1']
-    seq2 = row['Sequence_hTF2']
-    similarity = row['similarity']
+    # Widen the band by the length difference so cell (m, n) is always reachable
+    radius = BAND_WIDTH + abs(len(s1) - len(s2))
+    return _nw_banded_kernel(s1, s2, _BLOSUM62_I8, GAP_OPEN_PENALTY, GAP_EXTEND_PENALTY, radius)
 
-    # Handle cases where sequences were marked as "NOT_FOUND" in the previous step
-    if seq1 == "NOT_FOUND" or seq2 == "NOT_FOUND":
-        return hTF1, hTF2, math.nan
+# Device-side copy of the substitution matrix, created lazily INSIDE each worker
+# so the CUDA context is never initialized in the parent before fork.
+_BLOSUM62_GPU = None
 
-    # Ensure sequences are valid strings and not empty
-    if not isinstance(seq1, str) or not isinstance(seq2, str) or not seq1 or not seq2:
-        return hTF1, hTF2, math.nan # Return NaN for invalid or empty sequences
+# Traceback over host-side pointer matrices (used by the GPU path; the Numba
+# kernel carries its own inlined copy so it compiles as one unit)
+def _traceback_stats(s1: np.ndarray, s2: np.ndarray,
+                     ptr_H: np.ndarray, ptr_E: np.ndarray, ptr_F: np.ndarray) -> tuple:
+    """
+    Walks the Gotoh traceback pointers from (m, n) back to (0, 0) and returns
+    (matches, length). Pointer encoding matches `_nw_banded_kernel`.
+    """
+    matches = 0
+    length = 0
+    i, j = len(s1), len(s2)
+    state = 0  # 0 = H, 1 = E, 2 = F
+    while i > 0 or j > 0:
+        if state == 0:
+            p = ptr_H[i, j]
+            if p == 0:
+                length += 1
+                if s1[i - 1] == s2[j - 1]:
+                    matches += 1
+                i -= 1
+                j -= 1
+            else:
+                state = p  # hand over to the gap state at the same cell
+        elif state == 1:
+            p = ptr_E[i, j]
+            length += 1
+            j -= 1
+            state = 1 if p == 1 else 0
+        else:
+            p = ptr_F[i, j]
+            length += 1
+            i -= 1
+            state = 2 if p == 1 else 0
 
-    try:
-        # Perform global alignment using Needleman-Wunsch (nw) algorithm from parasail
-        # Use parasail.nw_stats to get alignment results with detailed statistics
-        alignment_result = parasail.nw_stats(seq1, seq2, GAP_OPEN_PENALTY, GAP_EXTEND_PENALTY, SCORING_MATRIX)
+    return matches, length
+
+# Full-matrix Needleman-Wunsch on the GPU, swept one anti-diagonal at a time
+def _nw_gpu_stats(s1: np.ndarray, s2: np.ndarray) -> tuple:
+    """
+    Computes a full-matrix global alignment of two integer-encoded sequences on
+    the GPU. All cells on one anti-diagonal of the DP matrix are independent,
+    so the matrix is swept diagonal by diagonal with each diagonal evaluated as
+    one vectorized CuPy operation across GPU threads. Scoring (BLOSUM62 +
+    affine gaps) and tie-breaking match the CPU kernels; the pointer matrices
+    are copied back to the host for the traceback.
+
+    Only worth it for very long pairs (see GPU_CELL_THRESHOLD) where a single
+    alignment would otherwise pin one CPU worker for a long time.
+
+    Args:
+        s1 (np.ndarray): First sequence as int8 BLOSUM62 row indices.
+        s2 (np.ndarray): Second sequence as int8 BLOSUM62 row indices.
+
+    Returns:
+        tuple: (matches, length) of the optimal alignment.
+    """
+    global _BLOSUM62_GPU
+    if _BLOSUM62_GPU is None:
+        _BLOSUM62_GPU = cupy.asarray(_BLOSUM62_I8, dtype=cupy.int32)
+
+    m, n = len(s1), len(s2)
+    s1_gpu = cupy.asarray(s1, dtype=cupy.int64)
+    s2_gpu = cupy.asarray(s2, dtype=cupy.int64)
+
+    # Same three-state Gotoh layout as the banded CPU kernel
+    H = cupy.full((m + 1, n + 1), _NEG_INF, dtype=cupy.int32)
+    E = cupy.full((m + 1, n + 1), _NEG_INF, dtype=cupy.int32)
+    F = cupy.full((m + 1, n + 1), _NEG_INF, dtype=cupy.int32)
+    ptr_H = cupy.zeros((m + 1, n + 1), dtype=cupy.uint8)
+    ptr_E = cupy.zeros((m + 1, n + 1), dtype=cupy.uint8)
+    ptr_F = cupy.zeros((m + 1, n + 1), dtype=cupy.uint8)
+
+    # Boundary conditions: leading gaps along the first row/column
+    H[0, 0] = 0
+    j0 = cupy.arange(1, n + 1)
+    E[0, 1:] = -(GAP_OPEN_PENALTY + (j0 - 1) * GAP_EXTEND_PENALTY)
+    H[0, 1:] = E[0, 1:]
+    ptr_H[0, 1:] = 1
+    ptr_E[0, 2:] = 1
+    i0 = cupy.arange(1, m + 1)
+    F[1:, 0] = -(GAP_OPEN_PENALTY + (i0 - 1) * GAP_EXTEND_PENALTY)
+    H[1:, 0] = F[1:, 0]
+    ptr_H[1:, 0] = 2
+    ptr_F[2:, 0] = 1
+
+    # Sweep anti-diagonals: every cell with i + j == d only depends on the two
+    # previous diagonals, so each diagonal is one data-parallel update
+    for d in range(2, m + n + 1):
+        i = cupy.arange(max(1, d - n), min(m, d - 1) + 1)
+        if i.size == 0:
+            continue
+        j = d - i
+
+        e_open = H[i, j - 1] - GAP_OPEN_PENALTY
+        e_ext = E[i, j - 1] - GAP_EXTEND_PENALTY
+        E[i, j] = cupy.maximum(e_open, e_ext)
+        ptr_E[i, j] = (e_ext > e_open).astype(cupy.uint8)
+
+        f_open = H[i - 1, j] - GAP_OPEN_PENALTY
+        f_ext = F[i - 1, j] - GAP_EXTEND_PENALTY
+        F[i, j] = cupy.maximum(f_open, f_ext)
+        ptr_F[i, j] = (f_ext > f_open).astype(cupy.uint8)
+
+        diag = H[i - 1, j - 1] + _BLOSUM62_GPU[s1_gpu[i - 1], s2_gpu[j - 1]]
+        best = diag
+        p = cupy.zeros(i.size, dtype=cupy.uint8)
+        e_wins = E[i, j] > best
+        best = cupy.where(e_wins, E[i, j], best)
+        p = cupy.where(e_wins, cupy.uint8(1), p)
+        f_wins = F[i, j] > best
+        best = cupy.where(f_wins, F[i, j], best)
+        p = cupy.where(f_wins, cupy.uint8(2), p)
+        H[i, j] = best
+        ptr_H[i, j] = p
+
+    # Traceback runs on the host: copy back only the byte-sized pointer matrices
+    return _traceback_stats(s1, s2,
+                            cupy.asnumpy(ptr_H), cupy.asnumpy(ptr_E), cupy.asnumpy(ptr_F))
 
-        # Check if alignment_result is not None and its length is valid before calculating percent identity
-        if alignment_result and alignment_result.length is not None and alignment_result.length > 0:
-            percent_identity = (alignment_result.matches / alignment_result.length) * 100
+# Per-process cache of k-mer profiles, keyed by hTF name. Populated lazily inside
+# the worker processes so each unique sequence is decomposed into k-mers only once.
+_KMER_CACHE = {}
+
+# Polynomial base powers used to hash each KMER_SIZE window of residue codes into
+# a single integer id. Base 26 covers the full 'A'..'Z' byte range collision-free.
+_KMER_BASES = 26 ** np.arange(KMER_SIZE - 1, -1, -1, dtype=np.int64)
+
+# Helper to get (and cache) the k-mer profile of one sequence
+def _kmer_profile(name: str, seq: str) -> tuple:
+    """
+    Returns the k-mer profile of `seq` as a pair of numpy arrays
+    (unique_kmer_ids, counts), caching the result per hTF name so repeated
+    appearances of the same TF are free.
+
+    The sequence is encoded once as a uint8 byte array and all overlapping
+    KMER_SIZE windows are hashed to integer ids in a handful of vectorized
+    numpy operations -- no per-character Python string slicing.
+    """
+    profile = _KMER_CACHE.get(name)
+    if profile is None:
+        seq_arr = np.frombuffer(seq.encode('ascii'), dtype=np.uint8).astype(np.int64) - ord('A')
+        if seq_arr.size < KMER_SIZE:
+            profile = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
         else:
-            # If alignment fails or results in zero length, consider similarity as 0% or NaN
-            percent_identity = 0.0 # Or math.nan if you prefer to distinguish
+            windows = np.lib.stride_tricks.sliding_window_view(seq_arr, KMER_SIZE)
+            kmer_ids = windows @ _KMER_BASES
+            profile = np.unique(kmer_ids, return_counts=True)
+        _KMER_CACHE[name] = profile
+    return profile
 
-    except Exception as e:
-        # Catch any unexpected errors during the alignment process
-        print(f"Error during alignment for pair {hTF1}-{hTF2}: {e}", file=sys.stderr)
-        percent_identity = math.nan # Indicate an error for this pair
+# Helper implementing the k-mer screen for one pair of sequences
+def _kmer_shared_fraction(profile1: tuple, profile2: tuple) -> float:
+    """
+    Computes the fraction of k-mers shared between two sequences (multiset
+    intersection of their profiles), normalized by the k-mer count of the
+    shorter one. Cheap screen that lets us skip the O(m*n) alignment for
+    clearly non-homologous pairs.
+    """
+    ids1, counts1 = profile1
+    ids2, counts2 = profile2
+    total1 = int(counts1.sum())
+    total2 = int(counts2.sum())
+    if total1 == 0 or total2 == 0:
+        return 0.0
+    _, idx1, idx2 = np.intersect1d(ids1, ids2, assume_unique=True, return_indices=True)
+    shared = int(np.minimum(counts1[idx1], counts2[idx2]).sum())
+    return shared / min(total1, total2)
+
+# Helper to check that a sequence fetched in the previous pipeline step is usable
+def _is_valid_sequence(seq) -> bool:
+    """
+    Returns True if `seq` is a non-empty protein sequence string that was
+    actually resolved by the UniProt query step (i.e. not the "NOT_FOUND" marker).
+    """
+    return isinstance(seq, str) and bool(seq) and seq != "NOT_FOUND"
+
+# Shared sequence storage, attached per worker process by `_attach_shared_sequences`.
+# All sequences live in ONE shared-memory blob created by the parent, so pool tasks
+# carry only hTF names instead of pickling full sequences through the pipe per task.
+_SHM = None         # SharedMemory handle (kept referenced to hold the mapping open)
+_SEQ_INDEX = None   # dict: hTF name -> (offset, length) into the blob, or None if invalid
+_SEQ_CACHE = None   # dict: hTF name -> decoded str, so each worker decodes a sequence once
+
+# Pool initializer: attach this worker to the parent's shared sequence blob
+def _attach_shared_sequences(shm_name: str, seq_index: dict) -> None:
+    """
+    Attaches the worker process to the shared-memory sequence blob created in
+    `main()` and installs the name -> (offset, length) index. Runs once per
+    worker via the Pool `initializer` hook.
+    """
+    global _SHM, _SEQ_INDEX, _SEQ_CACHE
+    _SHM = shared_memory.SharedMemory(name=shm_name)
+    _SEQ_INDEX = seq_index
+    _SEQ_CACHE = {}
+
+# Helper to resolve an hTF name to its sequence from the shared blob
+def _get_sequence(name: str) -> str | None:
+    """
+    Returns the protein sequence for `name` by slicing the shared blob
+    (decoded once per worker and cached), or None if the sequence was
+    marked invalid / NOT_FOUND in the input.
+    """
+    seq = _SEQ_CACHE.get(name)
+    if seq is None:
+        span = _SEQ_INDEX.get(name)
+        if span is None:
+            return None
+        offset, length = span
+        seq = bytes(_SHM.buf[offset:offset + length]).decode('ascii')
+        _SEQ_CACHE[name] = seq
+    return seq
+
+# Helper to build the canonical (order-independent) key for a pair of hTF names
+def make_pair_key(hTF1: str, hTF2: str) -> tuple:
+    """
+    Returns the canonical key for a pair of hTF names, so that (A, B) and (B, A)
+    map to the same key. Used to deduplicate symmetric pairs before alignment
+    and to broadcast the computed identities back onto all original rows.
+    """
+    return tuple(sorted((hTF1, hTF2)))
+
+# Function to calculate similarities for all pairs sharing one query sequence
+def calculate_similarities_for_query(task: tuple) -> list:
+    """
+    Calculates the global alignment (Needleman-Wunsch) percent identity for all
+    unique pairs that share the same query hTF, reusing a single parasail query
+    profile for the score-only first pass.
+
+    Building the striped query profile costs O(len(query) * alphabet_size); hub TFs
+    appear in hundreds of pairs, so building the profile once per query and reusing
+    it across all partners amortizes that cost (the SWIPE-style one-to-many pattern).
+    Only the score-only kernel takes a profile -- the stats rescore runs through the
+    non-profile kernel, since the stats profile entry points crash in parasail 1.3.4.
+
+    Sequences are NOT part of the task: they are resolved by name from the
+    shared-memory blob this worker attached to in `_attach_shared_sequences`,
+    so the pool pipe only ever carries hTF names.
+
+    Args:
+        task (tuple): A tuple (hTF1, partner_names) where `partner_names` lists
+                      the hTF2 of every unique pair whose query is hTF1.
+
+    Returns:
+        list: A list of result tuples (pair_key, (matches, length)), one per
+              partner, where `matches` is the number of identical alignment
+              columns and `length` the total alignment length. Percent identity
+              is 100 * matches / length, computed lazily by consumers; pairs
+              with missing or invalid sequences get (0, 0), whose ratio is NaN.
+    """
+    hTF1, partner_names = task
+    results = []
+
+    # If the query sequence itself is unusable, every pair in this group is (0, 0)
+    seq1 = _get_sequence(hTF1)
+    if seq1 is None:
+        return [(make_pair_key(hTF1, hTF2), (0, 0)) for hTF2 in partner_names]
+
+    # The query's k-mer counter is computed once for the whole group; the striped
+    # SIMD query profile is built lazily on the first partner that actually needs
+    # an alignment (the k-mer screen may reject every partner in the group).
+    # The "_sat" profile variant starts with narrow integer lanes and transparently
+    # falls back to wider ones on overflow.
+    query_kmers = _kmer_profile(hTF1, seq1)
+    score_profile = None  # score-only profile for the cheap first-pass estimate
+
+    for hTF2 in partner_names:
+        # Handle partners whose sequences were marked "NOT_FOUND" or are invalid
+        seq2 = _get_sequence(hTF2)
+        if seq2 is None:
+            results.append((make_pair_key(hTF1, hTF2), (0, 0)))
+            continue
+
+        # Identical sequences (self-pairs or duplicated entries) are by definition
+        # 100% identical -- short-circuit without running the aligner at all
+        if seq1 == seq2:
+            results.append((make_pair_key(hTF1, hTF2), (len(seq1), len(seq1))))
+            continue
+
+        # k-mer screen: pairs sharing almost no k-mers belong to clearly distinct
+        # TF families, so skip the expensive alignment and report 0% identity
+        # (zero matches over the minimum possible global alignment length)
+        partner_kmers = _kmer_profile(hTF2, seq2)
+        shared_fraction = _kmer_shared_fraction(query_kmers, partner_kmers)
+        if shared_fraction < KMER_SCREEN_THRESHOLD:
+            results.append((make_pair_key(hTF1, hTF2), (0, max(len(seq1), len(seq2)))))
+            continue
+
+        # Close homologs align near the diagonal: take the banded fast path,
+        # which only touches O(band * max(m, n)) cells instead of the full matrix.
+        # Worth it only as compiled code -- without Numba the parasail SIMD
+        # kernel below beats an interpreted banded loop.
+        if _NUMBA_AVAILABLE and shared_fraction >= KMER_BANDED_THRESHOLD:
+            try:
+                matches, length = _nw_banded_stats(_encode_sequence(hTF1, seq1),
+                                                   _encode_sequence(hTF2, seq2))
+                results.append((make_pair_key(hTF1, hTF2), (matches, length)))
+                continue
+            except Exception as e:
+                # Fall through to the unbanded SIMD kernel on any unexpected failure
+                print(f"Banded alignment failed for pair {hTF1}-{hTF2}, "
+                      f"falling back to parasail: {e}", file=sys.stderr)
+
+        # Very long pairs (big DP matrices) would pin one CPU worker for a long
+        # time; with CuPy available their anti-diagonal sweep runs on the GPU
+        if _CUPY_AVAILABLE and len(seq1) * len(seq2) > GPU_CELL_THRESHOLD:
+            try:
+                matches, length = _nw_gpu_stats(_encode_sequence(hTF1, seq1),
+                                                _encode_sequence(hTF2, seq2))
+                results.append((make_pair_key(hTF1, hTF2), (matches, length)))
+                continue
+            except Exception as e:
+                # Fall through to the CPU SIMD kernel on any GPU failure
+                print(f"GPU alignment failed for pair {hTF1}-{hTF2}, "
+                      f"falling back to parasail: {e}", file=sys.stderr)
+
+        try:
+            # Two-tier strategy: run the cheap score-only kernel first (a single
+            # scoring pass; nw_stats adds a second accumulation pass on top) and
+            # normalize the raw score by the smaller self-score into an identity
+            # estimate. Only pairs whose estimate clears STATS_RESCORE_THRESHOLD
+            # -- plausible homologs, where exact numbers matter -- pay for the
+            # precise stats alignment.
+            if score_profile is None:
+                score_profile = parasail.profile_create_sat(seq1, SCORING_MATRIX)
+            score_result = parasail.nw_striped_profile_sat(score_profile, seq2, GAP_OPEN_PENALTY, GAP_EXTEND_PENALTY)
+            min_self = min(_self_score(hTF1, seq1), _self_score(hTF2, seq2))
+            if min_self > 0:
+                estimated_identity = min(100.0, max(0.0, (score_result.score / min_self) * 100))
+            else:
+                estimated_identity = 0.0
+
+            if estimated_identity < STATS_RESCORE_THRESHOLD:
+                # Express the estimate as (matches, length) over the minimum
+                # possible global alignment length -- approximate by design,
+                # which is acceptable for pairs this far from homology
+                length = max(len(seq1), len(seq2))
+                matches = round(estimated_identity / 100 * length)
+            else:
+                # Perform the exact global alignment with statistics using the
+                # NON-profile striped kernel: the nw_stats_*_profile_* entry
+                # points segfault in parasail-python 1.3.4 (a C-level crash no
+                # except-clause can catch, which silently kills the pool
+                # worker). Profile reuse is only lost for these rescored pairs;
+                # the score-only profile path above keeps the amortization.
+                alignment_result = parasail.nw_stats_striped_sat(seq1, seq2, GAP_OPEN_PENALTY, GAP_EXTEND_PENALTY, SCORING_MATRIX)
 
-    return hTF1, hTF2, seq1, seq2, percent_identity, similarity
+                # Check if alignment_result is not None and its length is valid before recording the stats
+                if alignment_result and alignment_result.length is not None and alignment_result.length > 0:
+                    matches = alignment_result.matches
+                    length = alignment_result.length
+                else:
+                    # If alignment fails or results in zero length, report 0% identity
+                    matches, length = 0, max(len(seq1), len(seq2))
+
+        except Exception as e:
+            # Catch any unexpected errors during the alignment process
+            print(f"Error during alignment for pair {hTF1}-{hTF2}: {e}", file=sys.stderr)
+            matches, length = 0, 0  # (0, 0) marks an error for this pair (NaN ratio)
+
+        results.append((make_pair_key(hTF1, hTF2), (matches, length)))
+
+    return results
 
 # Main Script Execution
 def main():
     """
     Main function to orchestrate the sequence similarity calculation.
     It reads hTF pairs and their sequences from an input CSV,
-    calculates pairwise percent identity using global alignment (Needleman-Wunsch)
-    with parallel processing, and saves the results to an output CSV.
+    calculates pairwise alignment statistics using global alignment (Needleman-Wunsch)
+    with parallel processing, and saves the results to an output CSV or parquet file.
     """
     parser = argparse.ArgumentParser(
         description="Calculate pairwise protein sequence similarity (percent identity) "
@@ -84,8 +679,10 @@ def main():
     parser.add_argument(
         "-o", "--output",
         required=True,
-        help="Path to the output CSV file where similarity results will be saved. "
-             "Columns will be: 'hTF1', 'hTF2', 'Similarity_PercentIdentity'."
+        help="Path to the output file where similarity results will be saved. "
+             "A '.parquet' extension writes a compact parquet file (requires pyarrow); "
+             "anything else writes CSV. Results are stored as integer 'Matches' and "
+             "'AlignmentLength' columns; percent identity is 100 * Matches / AlignmentLength."
     )
     parser.add_argument(
         "-p", "--num_processes",
@@ -94,6 +691,15 @@ def main():
         help="Number of parallel processes to use for similarity calculation. "
              "Defaults to (CPU_count - 1) to leave one core free, or 1 if only one CPU is available."
     )
+    parser.add_argument(
+        "-r", "--min-length-ratio",
+        type=float,
+        default=0.3,
+        help="Minimum shorter/longer sequence length ratio required to align a pair. "
+             "Below this, the global alignment is dominated by gaps and its percent "
+             "identity is uninformative, so the pair is skipped with an undefined "
+             "(NaN) identity. Set to 0 to align every pair."
+    )
     args = parser.parse_args()
 
     print(f"Starting sequence similarity calculation script...")
@@ -118,29 +724,149 @@ def main():
         print(f"Error: Input CSV must contain all of the following columns: {required_columns}", file=sys.stderr)
         sys.exit(1)
 
-    # Convert the DataFrame rows into a list of dictionaries. Each dictionary
-    # represents a pair and will be passed to `calculate_similarity_for_pair`
-    data_for_pool = df_input.to_dict('records')
+    # Canonicalize each pair so (A, B) and (B, A) -- and exact duplicate rows --
+    # are aligned only once; the result is broadcast back onto every original row.
+    # Iterating the two name columns directly avoids the per-row Series objects
+    # that DataFrame.apply(axis=1) would materialize.
+    df_input['_pair_key'] = [make_pair_key(hTF1, hTF2)
+                             for hTF1, hTF2 in zip(df_input['hTF1'].values, df_input['hTF2'].values)]
+    df_unique = df_input.drop_duplicates('_pair_key')
+    print(f"{len(df_unique)} unique pairs to align (out of {len(df_input)} input rows).")
 
-    print(f"Beginning similarity calculations for {len(data_for_pool)} pairs...")
+    # Concatenate every unique sequence into ONE shared-memory blob plus a
+    # name -> (offset, length) index, so pool tasks carry only hTF names and the
+    # sequences themselves are never pickled through the worker pipe.
+    seq_index = {}
+    blob_parts = []
+    blob_size = 0
+    for name_col, seq_col in (('hTF1', 'Sequence_hTF1'), ('hTF2', 'Sequence_hTF2')):
+        for name, seq in zip(df_input[name_col], df_input[seq_col]):
+            if name in seq_index:
+                continue
+            if _is_valid_sequence(seq):
+                encoded = seq.encode('ascii')
+                seq_index[name] = (blob_size, len(encoded))
+                blob_parts.append(encoded)
+                blob_size += len(encoded)
+            else:
+                seq_index[name] = None  # NOT_FOUND / invalid: workers report NaN
+    blob = b''.join(blob_parts)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(blob)))
+    shm.buf[:len(blob)] = blob
 
-    # Use multiprocessing.Pool to parallelize the calculations
-    with multiprocessing.Pool(processes=args.num_processes) as pool:
-        # `imap` is used with `tqdm` to show a dynamic progress bar as results are generated.
-        # `chunksize` can be adjusted for performance, but the default often works well
-        results = list(tqdm(pool.imap(calculate_similarity_for_pair, data_for_pool),
-                            total=len(data_for_pool),
-                            desc="Calculating similarities"))
+    # Group the unique pairs by their query hTF so each worker task can build the
+    # parasail query profile once and reuse it across all partners of that query.
+    # Each task is (hTF1, [hTF2, ...]); sequences are resolved via shared memory.
+    #
+    # Pairs whose sequence lengths differ by more than the length-ratio gate are
+    # dropped here, before any dispatch: a global alignment between a short and
+    # a 10x longer protein is dominated by gaps and its identity is meaningless,
+    # so those pairs get an undefined (NaN) identity without any DP work.
+    pair_stats = {}  # pair_key -> (matches, length); (0, 0) divides to NaN
+    length_gated_pairs = 0
+    data_for_pool = []
+    for hTF1, group in df_unique.groupby('hTF1', sort=False):
+        span1 = seq_index.get(hTF1)
+        partner_names = []
+        for hTF2 in group['hTF2']:
+            span2 = seq_index.get(hTF2)
+            if span1 and span2:
+                len1, len2 = span1[1], span2[1]
+                if min(len1, len2) < args.min_length_ratio * max(len1, len2):
+                    pair_stats[make_pair_key(hTF1, hTF2)] = (0, 0)
+                    length_gated_pairs += 1
+                    continue
+            partner_names.append(hTF2)
+        if partner_names:
+            data_for_pool.append((hTF1, partner_names))
 
-    print("\nAll similarity calculations completed.")
+    # NW runtime scales with len(seq1) * len(seq2), so schedule Longest
+    # Processing Time first: sort groups by their total DP cell count
+    # descending. Default submission order would leave a few long-sequence
+    # stragglers running alone at the end of the pool.
+    def _group_cost(task):
+        hTF1, partner_names = task
+        span1 = seq_index.get(hTF1)
+        len1 = span1[1] if span1 else 0
+        return sum(len1 * (seq_index[hTF2][1] if seq_index.get(hTF2) else 0)
+                   for hTF2 in partner_names)
+
+    data_for_pool.sort(key=_group_cost, reverse=True)
 
-    # Create a new DataFrame from the collected results
-    # The columns are defined here to match the output of `calculate_similarity_for_pair`
-    df_output = pd.DataFrame(results, columns=['hTF1', 'hTF2', 'Sequence_hTF1', 'Sequence_hTF2', 'Similarity_PercentIdentity', 'Similarity']) 
+    # Warm up the Numba kernel once in the parent process so forked pool
+    # workers inherit the compiled code instead of each paying the JIT cost
+    if _NUMBA_AVAILABLE:
+        warmup = AA_TO_IDX[np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)]
+        _nw_banded_stats(warmup, warmup)
 
-    # Save the final results to the specified output CSV file
+    print(f"Beginning similarity calculations for {len(df_unique)} unique pairs "
+          f"({len(data_for_pool)} query groups)...")
+
+    # Use multiprocessing.Pool to parallelize the calculations across query groups.
+    # Every worker attaches to the shared sequence blob once via the initializer.
+    # Results are collected into pair_stats (pair_key -> (matches, length)) for
+    # the broadcast step below, alongside the length-gated entries added above.
+    # Dispatch one group per pickup (chunksize=1): query groups are already
+    # coarse tasks, and batching them would hand several of the heaviest
+    # (LPT-sorted, hence consecutive) groups to a single worker.
+    try:
+        with multiprocessing.Pool(processes=args.num_processes,
+                                  initializer=_attach_shared_sequences,
+                                  initargs=(shm.name, seq_index)) as pool:
+            # `imap_unordered` streams each group's results as soon as that worker
+            # finishes (results are keyed by pair, so arrival order is irrelevant);
+            # `tqdm` shows a dynamic progress bar as results are generated.
+            for group_results in tqdm(pool.imap_unordered(calculate_similarities_for_query,
+                                                          data_for_pool, chunksize=1),
+                                      total=len(data_for_pool),
+                                      desc="Calculating similarities"):
+                pair_stats.update(group_results)
+    finally:
+        # Release the shared-memory segment in all cases (it outlives the process otherwise)
+        shm.close()
+        shm.unlink()
+
+    print("\nAll similarity calculations completed.")
+    print(f"{length_gated_pairs} pairs skipped by the length-ratio gate "
+          f"(shorter/longer < {args.min_length_ratio}).")
+
+    # Broadcast the per-unique-pair stats back onto ALL original rows (symmetric
+    # duplicates included). Results are stored as integer matches / alignment
+    # length rather than a float percent: int16 columns take a quarter of the
+    # space and consumers compute 100 * Matches / AlignmentLength on demand
+    # ((0, 0) rows -- missing sequences or errors -- divide to NaN).
+    output_columns = ['hTF1', 'hTF2', 'Sequence_hTF1', 'Sequence_hTF2',
+                      'Matches', 'AlignmentLength', 'Similarity']
     try:
-        df_output.to_csv(args.output, index=False)
+        if args.output.endswith('.parquet'):
+            # Parquet keeps the int16 dtypes on disk and is ~10x smaller than
+            # the equivalent CSV, which also makes downstream re-loads faster
+            if not _PYARROW_AVAILABLE:
+                print("Error: pyarrow is required for parquet output but is not installed.",
+                      file=sys.stderr)
+                sys.exit(1)
+            stats = [pair_stats.get(key, (0, 0)) for key in df_input['_pair_key'].values]
+            table = pa.table({
+                'hTF1': pa.array(df_input['hTF1'].values),
+                'hTF2': pa.array(df_input['hTF2'].values),
+                'Sequence_hTF1': pa.array(df_input['Sequence_hTF1'].values),
+                'Sequence_hTF2': pa.array(df_input['Sequence_hTF2'].values),
+                'Matches': pa.array([s[0] for s in stats], type=pa.int16()),
+                'AlignmentLength': pa.array([s[1] for s in stats], type=pa.int16()),
+                'Similarity': pa.array(df_input['similarity'].values),
+            })
+            pq.write_table(table, args.output)
+        else:
+            # CSV fallback, streamed row by row to keep driver memory flat
+            with open(args.output, 'w', newline='') as output_file:
+                writer = csv.writer(output_file)
+                writer.writerow(output_columns)
+                for hTF1, hTF2, seq1, seq2, pair_key, similarity in zip(
+                        df_input['hTF1'].values, df_input['hTF2'].values,
+                        df_input['Sequence_hTF1'].values, df_input['Sequence_hTF2'].values,
+                        df_input['_pair_key'].values, df_input['similarity'].values):
+                    matches, length = pair_stats.get(pair_key, (0, 0))
+                    writer.writerow([hTF1, hTF2, seq1, seq2, matches, length, similarity])
         print(f"Successfully saved similarity results to {args.output}.")
     except Exception as e:
         print(f"Error saving output file {args.output}: {e}", file=sys.stderr)